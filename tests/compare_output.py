@@ -1,8 +1,11 @@
 # Portable Python script for numerical output file comparisons of MOPAC
-# Argument list: <output file #1> <output file #2>
+# Argument list: <reference file #1> <output file #1> ... <reference file #N> <output file #N>
 
 from shutil import copyfile
-from sys import argv
+from sys import argv, exit
+from functools import lru_cache
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 import subprocess
 import os
 import re
@@ -29,43 +32,107 @@ NUMERIC_THRESHOLD = 1e-4 # large because of numerical errors in unoccupied orbit
 HEAT_THRESHOLD = 1e-4
 DEGENERACY_THRESHOLD = 1e-3
 EIGVEC_THRESHOLD = 1e-3
+HEAT_ERROR_THRESHOLD = 1e-2 # default for command-line comparisons, same as HOF_ERROR in tests/CMakeLists.txt
 
 # regular expression pattern for a time stamp or other signifier of timing output, "CLOCK" or "TIME" or "SECONDS", & system-dependent versioning
 skip_criteria = re.compile('([A-Z][a-z][a-z] [A-Z][a-z][a-z] [ 0-9][0-9] [0-9][0-9]:[0-9][0-9]:[0-9][0-9] [0-9][0-9][0-9][0-9])'
                            '|(CLOCK)|(TIME)|(SECONDS)|(Version)|(THE VIBRATIONAL FREQUENCY)|(ITERATION)|(SCF CALCULATIONS)|(Stewart)'
                            '|(remaining)|(\*  THREADS)|(\*  ISOTOPE)|(\*  DENOUT)|(\*  OLDENS)|(\*  SETUP)|(ITER.)|(\*\* )|(web-site)|(MOPAC)|(GRADIENT NORM)')
 
-# regular expression pattern for an eigenvector block
-eigen_criteria = re.compile('(Root No.)|(ROOT NO.)')
+# substrings of which at least one appears in every line matched by skip_criteria (":" for the time stamp),
+# used to avoid running the full regular expression search on most lines
+skip_hints = (':','CLOCK','TIME','SECONDS','Version','THE VIBRATIONAL FREQUENCY','ITER','SCF CALCULATIONS','Stewart',
+              'remaining','* ','web-site','MOPAC','GRADIENT NORM')
 
-def is_float(string):
-    '''check if a string contains a float'''
+# header of an eigenvector block
+eigen_headers = ('Root No.','ROOT NO.')
+
+# types of the basic elements in a parsed MOPAC output file
+STRING, FLOAT, HEAT, EIGEN = range(4)
+
+# sentinel returned by to_float for strings that do not contain a float (distinct from a parsed 0.0)
+NOT_A_FLOAT = object()
+
+def to_float(string):
+    '''convert a string to a float, or return NOT_A_FLOAT if it does not contain one'''
+    # only Fortran-style exponents need to be rewritten before conversion
+    if 'D' in string or 'd' in string:
+        string = string.replace('D','E').replace('d','e')
     try:
-        float(string.replace('D','E'))
-        return True
+        return float(string)
     except ValueError:
-        return False
+        return NOT_A_FLOAT
 
-def to_float(string):
+def is_float(string):
     '''check if a string contains a float'''
+    return to_float(string) is not NOT_A_FLOAT
+
+def to_array(word_list):
+    '''convert a list of strings to a float array, or return None if they do not all contain floats'''
     try:
-        return float(string.replace('D','E'))
+        return np.array(word_list, dtype=float)
     except ValueError:
-        return False
+        # NumPy does not accept Fortran-style exponents, so fall back on to_float
+        value_list = [ to_float(word) for word in word_list ]
+        if any(value is NOT_A_FLOAT for value in value_list):
+            return None
+        return np.array(value_list)
+
+class MopacOutput:
+    '''basic elements of a parsed MOPAC output file, stored in a separate list for each type of element
+
+    Elements are added with append while parsing, and finalize must be called afterwards to convert the
+    per-element data & numbers into arrays before len, element, or compare_mopac_out_file are used.'''
+
+    def __init__(self):
+        self.lines = [] # line number of each element (array after finalize)
+        self.kinds = [] # type of each element, STRING, FLOAT, HEAT, or EIGEN (array after finalize)
+        self.index = None # position of each element in the list for its type (array set by finalize)
+        self.strings = []
+        self.floats = [] # (array after finalize)
+        self.heats = [] # (array after finalize)
+        self.eigens = [] # (eigenvalues or labels, eigenvectors, first root included, last root included)
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def elements(self, kind):
+        '''list of elements of a given type'''
+        return (self.strings, self.floats, self.heats, self.eigens)[kind]
+
+    def element(self, i):
+        '''element at a given position in the output file'''
+        return self.elements(self.kinds[i])[self.index[i]]
+
+    def append(self, line_num, kind, element):
+        '''append an element of a given type that was read on a given line'''
+        self.lines.append(line_num)
+        self.kinds.append(kind)
+        self.elements(kind).append(element)
+
+    def finalize(self):
+        '''convert the per-element data & numbers into arrays once parsing is complete'''
+        self.lines = np.array(self.lines, dtype=int)
+        self.kinds = np.array(self.kinds, dtype=np.int8)
+        self.index = np.empty(len(self.kinds), dtype=int)
+        for kind in (STRING, FLOAT, HEAT, EIGEN):
+            mask = self.kinds == kind
+            self.index[mask] = np.arange(np.count_nonzero(mask))
+        self.floats = np.array(self.floats, dtype=float)
+        self.heats = np.array(self.heats, dtype=float)
 
 def parse_mopac_out_file(path):
-    '''parse a MOPAC output file at a given path into a list of basic elements (strings, numbers, matrices)'''
-    parse_line = []
-    parse_list = []
+    '''parse a MOPAC output file at a given path into its basic elements (strings, numbers, matrices)'''
+    output = MopacOutput()
     mode = 'standard'
-    with open(path,'r') as file:
+    with open(path,'r',buffering=1<<20) as file: # large read buffer for multi-MB output files
         for line_num, line in enumerate(file):
 
-            # this hack separates floats that don't have a space between them because of a minus sign & trailing comma's
-            word_list = line.replace('-',' -').replace('E -','E-').replace('D -','D-').replace('=',' = ').replace(',',' , ').split()
+            # the headers that switch modes are printed at the start of a line, after leading spaces
+            header = line.lstrip()
 
             # ignore molecular dimensions block
-            if 'MOLECULAR DIMENSIONS (Angstroms)' in line:
+            if header.startswith('MOLECULAR DIMENSIONS (Angstroms)'):
                 mode = 'dim'
                 continue
             elif mode == 'dim':
@@ -75,7 +142,7 @@ def parse_mopac_out_file(path):
                     continue
 
             # switch to or continue iter mode
-            if 'RHF CALCULATION' in line or 'UHF CALCULATION' in line or 'Geometry optimization using BFGS' in line:
+            if header.startswith(('RHF CALCULATION','UHF CALCULATION','Geometry optimization using BFGS')):
                 mode = 'iter'
                 continue
             elif mode == 'iter':
@@ -85,11 +152,15 @@ def parse_mopac_out_file(path):
                     continue
 
             # skip lines as necessary
-            if skip_criteria.search(line):
+            if any(hint in line for hint in skip_hints) and skip_criteria.search(line):
                 continue
 
+            # this hack separates floats that don't have a space between them because of a minus sign & trailing comma's
+            # (only lines that survive the skipping above are split into words)
+            word_list = line.replace('-',' -').replace('E -','E-').replace('D -','D-').replace('=',' = ').replace(',',' , ').split()
+
             # switch to or continue geo mode
-            if 'ATOM    CHEMICAL      BOND LENGTH      BOND ANGLE     TWIST ANGLE' in line:
+            if header.startswith('ATOM    CHEMICAL      BOND LENGTH      BOND ANGLE     TWIST ANGLE'):
                 mode = 'geo'
             elif mode == 'geo':
                 if len(word_list) == 0:
@@ -98,7 +169,7 @@ def parse_mopac_out_file(path):
                     continue
 
             # switch to or continue lmo mode
-            if 'NUMBER OF CENTERS  LMO ENERGY     COMPOSITION OF ORBITALS' in line:
+            if header.startswith('NUMBER OF CENTERS  LMO ENERGY     COMPOSITION OF ORBITALS'):
                 mode = 'lmo'
             elif mode == 'lmo':
                 if 'LOCALIZED ORBITALS' in line:
@@ -107,7 +178,7 @@ def parse_mopac_out_file(path):
                     continue
 
             # switch to or continue grad mode
-            if 'LARGEST ATOMIC GRADIENTS' in line:
+            if header.startswith('LARGEST ATOMIC GRADIENTS'):
                 mode = 'grad'
                 blank_count = 0
             # simple-minded skipping based on counting blank lines
@@ -120,7 +191,7 @@ def parse_mopac_out_file(path):
                     continue
 
             # switch to or continue vibe mode
-            if 'DESCRIPTION OF VIBRATIONS' in line:
+            if header.startswith('DESCRIPTION OF VIBRATIONS'):
                 mode = 'vibe'
             elif mode == 'vibe':
                 if 'FORCE CONSTANT IN INTERNAL COORDINATES' in line or 'SYMMETRY NUMBER FOR POINT-GROUP' in line:
@@ -129,7 +200,7 @@ def parse_mopac_out_file(path):
                     continue
 
             # switch to or continue eigen mode
-            if eigen_criteria.search(line):
+            if header.startswith(eigen_headers):
                 if mode != 'eigen':
                     eigen_line_num = line_num+1
                     mode = 'eigen'
@@ -163,8 +234,8 @@ def parse_mopac_out_file(path):
                     pass
 
                 # save eigenvectors in a matrix
-                elif len(word_list) > num_eigen[-1] and all([is_float(word) for word in word_list[-num_eigen[-1]:]]):
-                    vector_list += [ float(word) for word in word_list[-num_eigen[-1]:] ]
+                elif len(word_list) > num_eigen[-1] and (vector_row := to_array(word_list[-num_eigen[-1]:])) is not None:
+                    vector_list.append(vector_row)
 
                 # ignore blank lines
                 elif len(word_list) == 0:
@@ -174,102 +245,133 @@ def parse_mopac_out_file(path):
                 else:
                     mode = 'standard'
 
-                    # reshape into a matrix
-                    nrow = len(vector_list) // len(label_list)
-                    ncol = len(label_list)
-                    eigenmatrix = np.empty((nrow,ncol))
-
-                    offset = 0
-                    for num in num_eigen:
-                        eigenmatrix[:,offset:offset+num] = np.reshape(vector_list[offset*nrow:(offset+num)*nrow],(nrow,num),order='C')
-                        offset += num
+                    # stack rows into a matrix, one group of columns (printed as nrow rows) at a time
+                    nrow = len(vector_list) // len(num_eigen)
+                    eigenmatrix = np.hstack([ np.reshape(vector_list[i*nrow:(i+1)*nrow],(nrow,num)) for i, num in enumerate(num_eigen) ])
 
                     # renormalize the eigenvectors (MOPAC uses a variety of normalizations)
-                    for col in eigenmatrix.T:
-                        col /= np.linalg.norm(col)
+                    np.divide(eigenmatrix, np.linalg.norm(eigenmatrix, axis=0), out=eigenmatrix)
 
                     # output eigenvalue (if known) and eigenvectors
                     if len(value_list) == len(label_list):
-                        parse_list.append((value_list,eigenmatrix,label_list[0] == 1,label_list[-1] == nrow))
+                        output.append(eigen_line_num, EIGEN, (np.asarray(value_list),eigenmatrix,label_list[0] == 1,label_list[-1] == nrow))
                     else:
-                        parse_list.append((label_list,eigenmatrix,label_list[0] == 1,label_list[-1] == nrow))
-                    parse_line.append(eigen_line_num)
+                        output.append(eigen_line_num, EIGEN, (np.asarray(label_list),eigenmatrix,label_list[0] == 1,label_list[-1] == nrow))
 
             # standard parsing
             if mode == 'standard':
-                for word in word_list:
-                    if is_float(word):
-                        if 'FINAL HEAT OF FORMATION =' in line and word is word_list[5]:
-                            parse_list.append(('HOF',to_float(word)))
-                        else:
-                            parse_list.append(to_float(word))
+                # the heat of formation is the 6th word of its line
+                heat_index = 5 if header.startswith('FINAL HEAT OF FORMATION =') else -1
+                for word_num, word in enumerate(word_list):
+                    value = to_float(word)
+                    if value is NOT_A_FLOAT:
+                        output.append(line_num+1, STRING, word)
+                    elif word_num == heat_index:
+                        output.append(line_num+1, HEAT, value)
                     else:
-                        parse_list.append(word)
-                    parse_line.append(line_num+1)
-
-    return parse_line, parse_list
-
-def compare_mopac_out_file(out_line, out_list, ref_line, ref_list, heat_error_threshold):
-    '''Compares the output to the given reference'''
-
-    if len(ref_list) != len(out_list):
-        assert len(ref_list) == len(out_list), f'ERROR: output file size mismatch, {len(ref_list)} vs. {len(out_list)}'
-        #print(f'WARNING: output file size mismatch, {len(ref_list)} vs. {len(out_list)}')
-
-    for (out_line0, out, ref_line0, ref) in zip(out_line, out_list, ref_line, ref_list):
-    #    print(ref, "vs.", out)
-        # check that types match
-        assert type(ref) == type(out), f'ERROR: type mismatch between {ref} on reference line {ref_line0} and {out} on output line {out_line0}'
-
-        # compare strings
-        if type(ref) is str:
-            assert ref == out, f'ERROR: string mismatch between {ref} on reference line {ref_line0} and {out} on output line {out_line0}'
-
-        # compare floats
-        elif type(ref) is float:
-    #        assert abs(ref - out) < NUMERIC_THRESHOLD, f'ERROR: numerical mismatch between {ref} and {out} on output line {line}'
-            if abs(ref - out) > NUMERIC_THRESHOLD:
-                print(f'WARNING: numerical mismatch between {ref} on reference line {ref_line0} and {out} on output line {out_line0}')
-
-        # compare heats of formation
-        elif len(ref) == 2:
-            assert abs(ref[1] - out[1]) < heat_error_threshold, f'ERROR: numerical heat mismatch between {ref[1]} on reference line {ref_line0} and {out[1]} on output line {out_line0}'
-            if abs(ref[1] - out[1]) > HEAT_THRESHOLD:
-                print(f'WARNING: numerical heat mismatch between {ref[1]} on reference line {ref_line0} and {out[1]} on output line {out_line0}')
- 
-        # compare eigenvalues & eigenvectors
-        elif len(ref) == 4:
-            ref_val, ref_vec, ref_begin, ref_end = ref
-            out_val, out_vec, ref_begin, ref_end = out
-
-            for refv, outv in zip(ref_val,out_val):
-    #            assert abs(refv - outv) < NUMERIC_THRESHOLD, f'ERROR: numerical mismatch between {refv} and {outv} on output line {line}'
-                if abs(refv - outv) > NUMERIC_THRESHOLD:
-                    print(f'WARNING: eigenvalue mismatch between {refv} on reference line {ref_line0} and {outv} on output line {out_line0}')
-
-                # build list of edges denoting degenerate subspaces
-                if ref_begin:
-                    edge_list = [0]
-                else:
-                    edge_list = []
-                edge_list += [ i+1 for i in range(len(ref_val)-1) if np.abs(ref_val[i] - ref_val[i+1]) > DEGENERACY_THRESHOLD ]
-                if ref_end:
-                    edge_list += [len(ref_val)]
-
-                # test the distance between each pair of degenerate subspaces
-                for i in range(len(edge_list)-1):
-                    overlap = ref_vec[:,edge_list[i]:edge_list[i+1]].T @ out_vec[:,edge_list[i]:edge_list[i+1]]
-    #                print("overlap = ",overlap)
-                    sval = np.linalg.svd(overlap, compute_uv=False)
-                    assert (sval[0] < 1.0 + EIGVEC_THRESHOLD) and (sval[-1] > 1.0 - EIGVEC_THRESHOLD), \
-                        f'ERROR: degenerate subspace mismatch between reference line {ref_line0} and output line {out_line0}, overlap range in [{min(sval)},{max(sval)}]'
+                        output.append(line_num+1, FLOAT, value)
+
+    output.finalize()
+    return output
+
+@lru_cache(maxsize=32)
+def _parse_mopac_out_file_cached(path, mtime, size):
+    '''parse a MOPAC output file, memoized on its path, modification time, & size'''
+    return parse_mopac_out_file(path)
+
+def parse_mopac_out_file_cached(path):
+    '''parse a MOPAC output file, reusing an earlier parse of the same file if it has not changed since'''
+    stat = os.stat(path)
+    return _parse_mopac_out_file_cached(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+def compare_mopac_out_file(out, ref, heat_error_threshold, report=print):
+    '''Compares the output to the given reference, passing warnings to report'''
+
+    if len(ref) != len(out):
+        assert len(ref) == len(out), f'ERROR: output file size mismatch, {len(ref)} vs. {len(out)}'
+        #print(f'WARNING: output file size mismatch, {len(ref)} vs. {len(out)}')
+
+    # check that types match, after which the elements of each type are aligned between the two files
+    type_error = np.flatnonzero(ref.kinds != out.kinds)
+    assert len(type_error) == 0, f'ERROR: type mismatch between {ref.element(type_error[0])} on reference line {ref.lines[type_error[0]]} ' \
+                                 f'and {out.element(type_error[0])} on output line {out.lines[type_error[0]]}'
+
+    # compare strings
+    ref_line, out_line = ref.lines[ref.kinds == STRING], out.lines[out.kinds == STRING]
+    for (out_line0, out0, ref_line0, ref0) in zip(out_line, out.strings, ref_line, ref.strings):
+        assert ref0 == out0, f'ERROR: string mismatch between {ref0} on reference line {ref_line0} and {out0} on output line {out_line0}'
+
+    # compare floats
+    ref_line, out_line = ref.lines[ref.kinds == FLOAT], out.lines[out.kinds == FLOAT]
+    for i in np.flatnonzero(np.abs(ref.floats - out.floats) > NUMERIC_THRESHOLD):
+        report(f'WARNING: numerical mismatch between {ref.floats[i]} on reference line {ref_line[i]} and {out.floats[i]} on output line {out_line[i]}')
+
+    # compare heats of formation
+    ref_line, out_line = ref.lines[ref.kinds == HEAT], out.lines[out.kinds == HEAT]
+    heat_diff = np.abs(ref.heats - out.heats)
+    for i in np.flatnonzero(~(heat_diff < heat_error_threshold) | (heat_diff > HEAT_THRESHOLD)):
+        assert heat_diff[i] < heat_error_threshold, f'ERROR: numerical heat mismatch between {ref.heats[i]} on reference line {ref_line[i]} and {out.heats[i]} on output line {out_line[i]}'
+        report(f'WARNING: numerical heat mismatch between {ref.heats[i]} on reference line {ref_line[i]} and {out.heats[i]} on output line {out_line[i]}')
+
+    # compare eigenvalues & eigenvectors
+    ref_line, out_line = ref.lines[ref.kinds == EIGEN], out.lines[out.kinds == EIGEN]
+    for (out_line0, out0, ref_line0, ref0) in zip(out_line, out.eigens, ref_line, ref.eigens):
+        ref_val, ref_vec, ref_begin, ref_end = ref0
+        out_val, out_vec, ref_begin, ref_end = out0
+
+        nval = min(len(ref_val), len(out_val))
+        for i in np.flatnonzero(np.abs(np.subtract(ref_val[:nval], out_val[:nval])) > NUMERIC_THRESHOLD):
+            report(f'WARNING: eigenvalue mismatch between {ref_val[i]} on reference line {ref_line0} and {out_val[i]} on output line {out_line0}')
+
+        # build list of edges denoting degenerate subspaces
+        if ref_begin:
+            edge_list = [0]
+        else:
+            edge_list = []
+        edge_list += (np.flatnonzero(np.abs(np.diff(ref_val)) > DEGENERACY_THRESHOLD) + 1).tolist()
+        if ref_end:
+            edge_list += [len(ref_val)]
+
+        # test the distance between each pair of degenerate subspaces
+        for i in range(len(edge_list)-1):
+            overlap = ref_vec[:,edge_list[i]:edge_list[i+1]].T @ out_vec[:,edge_list[i]:edge_list[i+1]]
+    #        print("overlap = ",overlap)
+            sval = np.linalg.svd(overlap, compute_uv=False)
+            assert (sval[0] < 1.0 + EIGVEC_THRESHOLD) and (sval[-1] > 1.0 - EIGVEC_THRESHOLD), \
+                f'ERROR: degenerate subspace mismatch between reference line {ref_line0} and output line {out_line0}, overlap range in [{min(sval)},{max(sval)}]'
+
+def compare_pair(ref_path, out_path, heat_error_threshold):
+    '''Compares the output file to the given reference file, returning its warnings & error message (None if it passes)'''
+    warnings = []
+    try:
+        compare_mopac_out_file(parse_mopac_out_file(out_path), parse_mopac_out_file_cached(ref_path), heat_error_threshold, warnings.append)
+    except AssertionError as err:
+        return warnings, str(err)
+    except (OSError, ValueError) as err:
+        return warnings, f'ERROR: could not compare {out_path} to {ref_path}: {err}'
+    return warnings, None
 
 # stub main for command-line comparisons
 if __name__ == "__main__":
 
-    # parse the 2 output files that we are comparing
-    ref_line, ref_list = parse_mopac_out_file(argv[1])
-    out_line, out_list = parse_mopac_out_file(argv[2])
-
-    # Run the comparison
-    compare_mopac_out_file(out_line, out_list, ref_line, ref_list)
+    # require at least one complete pair of files
+    if len(argv) < 3 or len(argv) % 2 == 0:
+        print(f'usage: {argv[0]} <reference file #1> <output file #1> ... <reference file #N> <output file #N>')
+        exit(2)
+
+    # parse & compare each pair of files in parallel
+    ref_paths, out_paths = argv[1::2], argv[2::2]
+    with ProcessPoolExecutor() as executor:
+        results = list(executor.map(compare_pair, ref_paths, out_paths, repeat(HEAT_ERROR_THRESHOLD)))
+
+    # report the results in the order of the argument list
+    failed = False
+    for ref_path, out_path, (warnings, error) in zip(ref_paths, out_paths, results):
+        print(f'Comparing {out_path} to {ref_path}')
+        for warning in warnings:
+            print(warning)
+        if error is not None:
+            print(error)
+            failed = True
+    if failed:
+        exit(1)
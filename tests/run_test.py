@@ -26,8 +26,8 @@ out_name = argv[4][:-3]+'out'
 ref_path = os.path.join(argv[1],out_name)
 
 # parse the 2 output files that we are comparing
-ref_line, ref_list = parse_mopac_out_file(ref_path)
-out_line, out_list = parse_mopac_out_file(out_name)
+ref = parse_mopac_out_file(ref_path)
+out = parse_mopac_out_file(out_name)
 
 # Run the comparison
-compare_mopac_out_file(out_line, out_list, ref_line, ref_list, float(argv[3]))
+compare_mopac_out_file(out, ref, float(argv[3]))